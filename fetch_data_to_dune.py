@@ -7,16 +7,20 @@
 3. TVL дані з контрактів (через DeFiLlama API) - з часовими мітками
 4. Funding rates history - нові дані
 5. Order book snapshots - нові дані
-Зберігає все в окремі CSV файли для Dune Analytics з дедуплікацією
+Зберігає все в окремі Parquet файли для Dune Analytics з дедуплікацією
+(CSV для Dune генерується з parquet під час завантаження)
 """
 
-import requests
+import asyncio
+import aiohttp
 import pandas as pd
+import numpy as np
+import fastparquet
+import duckdb
 import os
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
-import json
-import hashlib
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+import orjson
 import time
 
 # === КОНФІГУРАЦІЯ ===
@@ -25,6 +29,26 @@ TIMEOUT = 30
 MAX_RETRIES = 3
 RETRY_DELAY = 2
 
+# Файли з історією даних
+MARKETS_FILE = os.path.join(UPLOADS_DIR, "extended_markets_data.parquet")
+TRADING_FILE = os.path.join(UPLOADS_DIR, "extended_trading_stats.parquet")
+TVL_FILE = os.path.join(UPLOADS_DIR, "extended_tvl_data.parquet")
+FUNDING_FILE = os.path.join(UPLOADS_DIR, "extended_funding_rates.parquet")
+ORDERBOOK_FILE = os.path.join(UPLOADS_DIR, "extended_orderbook_snapshots.parquet")
+
+# Кількість рядків у файлах після збереження в цьому запуску (для підсумку)
+ROW_COUNTS: Dict[str, int] = {}
+
+# Кеш статистики торгів за закриті дні (дані за минулі дні вже не змінюються)
+TRADING_STATS_CACHE_DIR = os.path.join(".cache", "trading_stats")
+TRADING_STATS_CACHE_TTL = 7 * 86400
+
+# Глибина історії статистики торгів (днів), запитується одним діапазоном на мережу
+TRADING_HISTORY_DAYS = 30
+
+# Файли дописуються без перезапису, поки не перевищать max_rows * COMPACTION_FACTOR
+COMPACTION_FACTOR = 1.2
+
 # API endpoints для різних мереж
 ENDPOINTS = {
     'ethereum': {
@@ -43,30 +67,65 @@ ENDPOINTS = {
     }
 }
 
+CHAINS = list(ENDPOINTS)
+
 # DeFiLlama TVL endpoint
 DEFILLAMA_TVL_API = "https://api.llama.fi/protocol/extended"
 
+# Заголовки для всіх запитів до API
+HEADERS = {"Accept": "application/json", "User-Agent": "extended-dune/1.0"}
+
+# Обмеження паралельності для async запитів, щоб не впертися в rate limit
+ASYNC_CONCURRENCY = 32
+ASYNC_LIMIT_PER_HOST = 8
+
+# Keep-alive з'єднань та кеш DNS (секунди) - запити до API йдуть кількома хвилями
+# (markets/funding/trading, потім order book), з'єднання переживають паузу між ними
+KEEPALIVE_TIMEOUT = 60
+DNS_CACHE_TTL = 300
+
+# Скільки топ ринків знімати в order book snapshots та скільки з них запитувати одночасно
+ORDERBOOK_TOP_MARKETS = 5
+ORDERBOOK_CONCURRENCY = 5
+
 def ensure_uploads_dir():
     """Створює папку uploads якщо її немає"""
     os.makedirs(UPLOADS_DIR, exist_ok=True)
     print("📁 Uploads directory ready")
 
-def make_request_with_retry(url: str, params: Dict = None) -> Optional[Dict]:
-    """Робить запит з повтором при помилці"""
+async def _retry_async(coro_factory: Callable[[], Awaitable], url: str):
+    """
+    Повтор запиту з експоненційною затримкою через asyncio.sleep, щоб не блокувати
+    інші запити в event loop. Для 429/503 враховує заголовок Retry-After, але не довше
+    за TIMEOUT секунд, щоб один запит не зупиняв весь запуск.
+    """
     for attempt in range(MAX_RETRIES):
         try:
-            response = requests.get(url, params=params, timeout=TIMEOUT)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
+            return await coro_factory()
+        except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
             print(f"❌ Attempt {attempt + 1}/{MAX_RETRIES} failed for {url}: {e}")
-            if attempt < MAX_RETRIES - 1:
-                time.sleep(RETRY_DELAY)
-            else:
-                return None
-    return None
+            if attempt == MAX_RETRIES - 1:
+                raise
+            
+            delay = RETRY_DELAY * 2 ** attempt
+            if isinstance(e, aiohttp.ClientResponseError) and e.status in (429, 503) and e.headers:
+                retry_after = e.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    delay = max(delay, min(int(retry_after), TIMEOUT))
+            await asyncio.sleep(delay)
 
-def fetch_markets_data(chain: str) -> List[Dict]:
+async def make_request(session: aiohttp.ClientSession, url: str, params: Dict = None) -> Optional[Dict]:
+    """Робить запит з повтором при помилці, None якщо всі спроби невдалі"""
+    async def request():
+        async with session.get(url, params=params) as response:
+            return orjson.loads(await response.read())
+    
+    try:
+        return await _retry_async(request, url)
+    except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError):
+        return None
+
+async def fetch_markets_data(session: aiohttp.ClientSession, chain: str) -> List[Dict]:
     """
     Отримує дані ринків (markets) для конкретної мережі
     Повертає список ринків з цінами, обсягами та open interest
@@ -74,7 +133,7 @@ def fetch_markets_data(chain: str) -> List[Dict]:
     url = ENDPOINTS[chain]['markets']
     print(f"🔄 Fetching markets data for {chain}...")
     
-    data = make_request_with_retry(url)
+    data = await make_request(session, url)
     if not data:
         return []
     
@@ -82,81 +141,201 @@ def fetch_markets_data(chain: str) -> List[Dict]:
     print(f"✅ Got {len(markets)} markets from {chain}")
     return markets or []
 
-def fetch_trading_stats(chain: str, date: str) -> Dict:
+def parse_trading_stats(chain: str, date: str, data: Optional[Dict]) -> Dict:
     """
-    Отримує статистику торгів для конкретної дати та мережі
+    Перетворює відповідь trading stats API в денний запис статистики
     """
-    url = ENDPOINTS[chain]['trading']
-    params = {'fromDate': date, 'toDate': date}
-    print(f"🔄 Fetching trading stats for {chain} on {date}...")
-    
-    data = make_request_with_retry(url, params)
+    empty = {'date': date, 'chain': chain, 'daily_volume': 0, 'trades_count': 0, 'unique_traders': 0, 'avg_trade_size': 0}
     if not data:
-        return {'date': date, 'chain': chain, 'daily_volume': 0, 'trades_count': 0}
+        return empty
     
     # Обробляємо дані статистики
     if isinstance(data, dict) and 'data' in data:
         trading_data = data['data']
         if trading_data:
-            total_volume = sum(float(item.get('tradingVolume', 0)) for item in trading_data)
-            unique_traders = len(set(item.get('trader', '') for item in trading_data if item.get('trader')))
+            # Агрегуємо векторизовано (native типи - для JSON кешу)
+            trades = pd.DataFrame(trading_data).reindex(columns=['tradingVolume', 'trader'])
+            total_volume = float(pd.to_numeric(trades['tradingVolume'], errors='coerce').fillna(0).sum())
+            unique_traders = int(trades['trader'].replace('', np.nan).dropna().nunique())
             
             return {
                 'date': date,
                 'chain': chain,
                 'daily_volume': total_volume,
-                'trades_count': len(trading_data),
+                'trades_count': len(trades),
                 'unique_traders': unique_traders,
-                'avg_trade_size': total_volume / len(trading_data) if trading_data else 0
+                'avg_trade_size': total_volume / len(trades)
             }
     
-    return {'date': date, 'chain': chain, 'daily_volume': 0, 'trades_count': 0, 'unique_traders': 0, 'avg_trade_size': 0}
+    return empty
+
+def _trading_stats_cache_path(chain: str, date: str) -> str:
+    return os.path.join(TRADING_STATS_CACHE_DIR, f"{chain}_{date}.json")
+
+def load_cached_trading_stats(chain: str, date: str) -> Optional[Dict]:
+    """
+    Повертає закешовану статистику за закритий день (раніше сьогодні по UTC), якщо кеш не застарів.
+    Нульові записи (збережені старішими версіями кешу) вважаються промахом
+    """
+    if date >= datetime.utcnow().strftime('%Y-%m-%d'):
+        return None
+    
+    path = _trading_stats_cache_path(chain, date)
+    try:
+        if time.time() - os.path.getmtime(path) < TRADING_STATS_CACHE_TTL:
+            with open(path, 'rb') as f:
+                stats = orjson.loads(f.read())
+            if isinstance(stats, dict) and stats.get('trades_count'):
+                return stats
+    except (OSError, ValueError):
+        pass
+    return None
 
-def fetch_funding_rates(chain: str) -> List[Dict]:
+def cache_trading_stats(chain: str, date: str, stats: Dict):
+    """
+    Зберігає статистику в кеш, тільки для закритих днів з торгами: порожня відповідь
+    може бути тимчасовою, і нулі не мають закріплюватись на весь TTL
+    """
+    if date >= datetime.utcnow().strftime('%Y-%m-%d') or not stats.get('trades_count'):
+        return
+    
+    try:
+        os.makedirs(TRADING_STATS_CACHE_DIR, exist_ok=True)
+        with open(_trading_stats_cache_path(chain, date), 'wb') as f:
+            f.write(orjson.dumps(stats))
+    except OSError as e:
+        print(f"⚠️ Could not cache trading stats for {chain} on {date}: {e}")
+
+async def fetch_trading_stats(session: aiohttp.ClientSession, chain: str, date: str) -> Dict:
+    """
+    Отримує статистику торгів для конкретної дати та мережі
+    """
+    url = ENDPOINTS[chain]['trading']
+    params = {'fromDate': date, 'toDate': date}
+    cached = load_cached_trading_stats(chain, date)
+    if cached is not None:
+        return cached
+    
+    print(f"🔄 Fetching trading stats for {chain} on {date}...")
+    
+    data = await make_request(session, url, params)
+    stats = parse_trading_stats(chain, date, data)
+    if data:
+        cache_trading_stats(chain, date, stats)
+    return stats
+
+def split_trading_stats_by_date(chain: str, data: Optional[Dict], dates: List[str]) -> Optional[List[Dict]]:
+    """
+    Розбиває відповідь trading stats API за діапазон дат на денні записи.
+    Повертає None, якщо відповідь порожня або її не можна розбити по днях (немає дати в записах,
+    дата не у форматі YYYY-MM-DD або поза запитаними днями - тоді діапазон не підтримується).
+    Нульові записи створюються лише для днів між першою та останньою датою у відповіді
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('data'), list) or not data['data']:
+        return None
+    
+    items_by_date = {date: [] for date in dates}
+    for item in data['data']:
+        item_date = str(item.get('date') or '')[:10] if isinstance(item, dict) else ''
+        try:
+            datetime.strptime(item_date, '%Y-%m-%d')
+        except ValueError:
+            return None
+        if item_date not in items_by_date:
+            return None
+        items_by_date[item_date].append(item)
+    
+    covered = [date for date, items in items_by_date.items() if items]
+    first, last = min(covered), max(covered)
+    return [parse_trading_stats(chain, date, {'data': items})
+            for date, items in items_by_date.items() if first <= date <= last]
+
+async def fetch_trading_stats_range(session: aiohttp.ClientSession, chain: str, dates: List[str]) -> List[Dict]:
+    """
+    Статистика торгів мережі за список дат: закриті дні з кешу, решта - одним запитом
+    за діапазон (дні, які відповідь за діапазон не покриває або не розбивається по датах, - по днях)
+    """
+    stats_by_date = {}
+    for date in dates:
+        cached = load_cached_trading_stats(chain, date)
+        if cached is not None:
+            stats_by_date[date] = cached
+    
+    missing = [date for date in dates if date not in stats_by_date]
+    if missing:
+        from_date, to_date = min(missing), max(missing)
+        print(f"🔄 Fetching trading stats for {chain} from {from_date} to {to_date}...")
+        
+        params = {'fromDate': from_date, 'toDate': to_date}
+        data = await make_request(session, ENDPOINTS[chain]['trading'], params)
+        ranged = split_trading_stats_by_date(chain, data, missing)
+        if ranged is None and from_date == to_date:
+            # Діапазон з одного дня - це вже денний запит, повторювати його не потрібно
+            ranged = [parse_trading_stats(chain, from_date, data)]
+        
+        if ranged is None:
+            print(f"⚠️ Ranged trading stats for {chain} empty or not split by date, fetching per day")
+            ranged = []
+        for stats in ranged:
+            cache_trading_stats(chain, stats['date'], stats)
+            stats_by_date[stats['date']] = stats
+        
+        # Дні, які відповідь за діапазон не покриває, - окремими денними запитами
+        uncovered = [date for date in missing if date not in stats_by_date]
+        for stats in await asyncio.gather(*[fetch_trading_stats(session, chain, date) for date in uncovered]):
+            stats_by_date[stats['date']] = stats
+    
+    return [stats_by_date[date] for date in dates]
+
+async def fetch_funding_rates(session: aiohttp.ClientSession, chain: str) -> pd.DataFrame:
     """
     Отримує історію funding rates для всіх ринків
     """
     url = ENDPOINTS[chain]['funding']
     print(f"🔄 Fetching funding rates for {chain}...")
     
-    data = make_request_with_retry(url)
+    data = await make_request(session, url)
     if not data:
-        return []
+        return pd.DataFrame()
     
     funding_data = data.get("data", []) if isinstance(data, dict) else data
     
-    # Нормалізуємо дані
-    normalized_data = []
-    for item in funding_data:
-        if isinstance(item, dict):
-            normalized_data.append({
-                'chain': chain,
-                'market': item.get('market', 'UNKNOWN'),
-                'funding_rate': float(item.get('fundingRate', 0) or 0),
-                'funding_time': item.get('fundingTime', ''),
-                'next_funding_time': item.get('nextFundingTime', ''),
-                'fetched_at': datetime.utcnow().isoformat() + "Z"
-            })
+    # Нормалізуємо дані одразу в DataFrame (object - щоб цілі мітки часу не ставали float через пропуски)
+    raw = pd.DataFrame([item for item in funding_data if isinstance(item, dict)], dtype=object)
+    raw = raw.reindex(columns=['market', 'fundingRate', 'fundingTime', 'nextFundingTime'])
+    normalized_data = pd.DataFrame({
+        'chain': chain,
+        'market': raw['market'].fillna('UNKNOWN'),
+        'funding_rate': pd.to_numeric(raw['fundingRate'], errors='coerce').fillna(0.0),
+        # Мітки часу - завжди рядки (число або пропуск не змішуються в одній колонці)
+        'funding_time': raw['fundingTime'].fillna('').astype(str),
+        'next_funding_time': raw['nextFundingTime'].fillna('').astype(str),
+        'fetched_at': datetime.utcnow().isoformat() + "Z"
+    })
     
     print(f"✅ Got {len(normalized_data)} funding records from {chain}")
     return normalized_data
 
-def fetch_orderbook_snapshots(chain: str, markets: List[str]) -> List[Dict]:
+async def fetch_orderbook_snapshots(session: aiohttp.ClientSession, chain: str, markets: List[str]) -> pd.DataFrame:
     """
-    Отримує snapshots order book для топ ринків
+    Отримує snapshots order book для топ ринків (запити по ринках паралельно)
     """
     snapshots = []
     url = ENDPOINTS[chain]['orderbook']
     
     # Беремо тільки топ 5 ринків щоб не перевантажувати API
-    top_markets = markets[:5]
+    top_markets = markets[:ORDERBOOK_TOP_MARKETS]
+    sem = asyncio.Semaphore(ORDERBOOK_CONCURRENCY)
     
-    for market in top_markets:
-        print(f"🔄 Fetching orderbook for {chain}:{market}...")
-        params = {'market': market}
-        
-        data = make_request_with_retry(url, params)
-        if not data:
+    async def fetch_one(market: str) -> Optional[Dict]:
+        async with sem:
+            print(f"🔄 Fetching orderbook for {chain}:{market}...")
+            return await make_request(session, url, {'market': market})
+    
+    results = await asyncio.gather(*[fetch_one(market) for market in top_markets], return_exceptions=True)
+    
+    for market, data in zip(top_markets, results):
+        if not data or isinstance(data, BaseException):
             continue
             
         orderbook = data.get("data", {})
@@ -187,102 +366,251 @@ def fetch_orderbook_snapshots(chain: str, markets: List[str]) -> List[Dict]:
             })
     
     print(f"✅ Got {len(snapshots)} orderbook snapshots from {chain}")
-    return snapshots
+    return pd.DataFrame(snapshots)
 
-def fetch_tvl_data() -> Optional[Dict]:
+async def fetch_tvl_data(session: aiohttp.ClientSession) -> Optional[Dict]:
     """Отримує TVL дані з DeFiLlama"""
     print("🔄 Fetching TVL data from DeFiLlama...")
     
-    data = make_request_with_retry(DEFILLAMA_TVL_API)
+    data = await make_request(session, DEFILLAMA_TVL_API)
     if data:
         print("✅ Got TVL data from DeFiLlama")
     return data
 
-def normalize_markets_data(markets: List[Dict], chain: str) -> List[Dict]:
-    """Нормалізує дані ринків в уніфікований формат"""
-    rows = []
+# Числові колонки з marketStats
+MARKET_NUMERIC_COLUMNS = [
+    "lastPrice", "bidPrice", "askPrice", "markPrice", "indexPrice",  # Ціни
+    "dailyVolume", "dailyVolumeBase", "openInterest",  # Обсяги та інтереси
+    "fundingRate", "priceChange24h",  # Додаткові метрики
+]
+
+def normalize_markets_data(markets: List[Dict], chain: str) -> pd.DataFrame:
+    """Нормалізує дані ринків в уніфікований формат (векторизовано через pandas)"""
     fetched_at = datetime.utcnow().isoformat() + "Z"
     
-    for market in markets:
-        if not isinstance(market, dict):
-            continue
-            
-        stats = market.get("marketStats", {})
-        
-        # Створюємо унікальний ID для дедуплікації
-        unique_id = f"{chain}_{market.get('name', 'UNKNOWN')}_{fetched_at[:16]}"  # До хвилини
-        
-        row = {
-            "unique_id": unique_id,
-            "fetched_at": fetched_at,
-            "chain": chain,
-            "market": market.get("name", "UNKNOWN"),
-            
-            # Ціни
-            "lastPrice": float(stats.get("lastPrice", 0) or 0),
-            "bidPrice": float(stats.get("bidPrice", 0) or 0),
-            "askPrice": float(stats.get("askPrice", 0) or 0),
-            "markPrice": float(stats.get("markPrice", 0) or 0),
-            "indexPrice": float(stats.get("indexPrice", 0) or 0),
-            
-            # Обсяги та інтереси
-            "dailyVolume": float(stats.get("dailyVolume", 0) or 0),
-            "dailyVolumeBase": float(stats.get("dailyVolumeBase", 0) or 0),
-            "openInterest": float(stats.get("openInterest", 0) or 0),
-            
-            # Додаткові метрики
-            "fundingRate": float(stats.get("fundingRate", 0) or 0),
-            "priceChange24h": float(stats.get("priceChange24h", 0) or 0),
-            
-            # Розраховуємо spread
-            "spread_pct": 0,
-        }
-        
-        # Розраховуємо spread
-        if row["bidPrice"] > 0 and row["askPrice"] > 0 and row["lastPrice"] > 0:
-            row["spread_pct"] = (row["askPrice"] - row["bidPrice"]) / row["lastPrice"] * 100
-            
-        rows.append(row)
+    # Розгортаємо вкладені marketStats в колонки за один прохід
+    markets = [market for market in markets if isinstance(market, dict)]
+    stats_columns = [f"marketStats_{col}" for col in MARKET_NUMERIC_COLUMNS]
+    raw = pd.json_normalize(markets, sep="_").reindex(columns=["name"] + stats_columns)
+    names = raw["name"].fillna("UNKNOWN").astype(str)
+    
+    df = raw[stats_columns].set_axis(MARKET_NUMERIC_COLUMNS, axis=1)
+    df = df.apply(pd.to_numeric, errors="coerce").fillna(0.0)
+    
+    # Розраховуємо spread одним numpy виразом (без вирівнювання індексів pandas)
+    bid, ask, last = (df[col].to_numpy() for col in ("bidPrice", "askPrice", "lastPrice"))
+    has_prices = (bid > 0) & (ask > 0) & (last > 0)
+    df["spread_pct"] = np.where(has_prices, (ask - bid) / np.where(has_prices, last, 1.0) * 100, 0.0)
+    
+    # Створюємо унікальний ID для дедуплікації (до хвилини)
+    df.insert(0, "market", names)
+    df.insert(0, "chain", chain)
+    df.insert(0, "fetched_at", fetched_at)
+    df.insert(0, "unique_id", f"{chain}_" + names + f"_{fetched_at[:16]}")
+    
+    return df
+
+def _meta_path(file_path: str) -> str:
+    """Шлях до sidecar файлу з метаданими (кількість рядків, колонки, ключі)"""
+    return file_path + ".meta"
+
+def _load_meta(file_path: str) -> Optional[Dict]:
+    """
+    Читає sidecar метадані файлу, None якщо їх немає або вони пошкоджені.
+    Перший рядок - стан після останнього перезапису, далі по рядку на кожне дописування
+    """
+    try:
+        with open(_meta_path(file_path), 'rb') as f:
+            meta, *appends = [orjson.loads(line) for line in f if line.strip()]
+        for delta in appends:
+            meta['rows'] += delta['rows']
+            for col, values in delta['keys'].items():
+                meta['keys'][col].extend(values)
+        return meta
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def _save_meta(file_path: str, df: pd.DataFrame, unique_columns: List[str]):
+    """Записує sidecar метадані для поточного вмісту файлу"""
+    _write_meta(file_path, {
+        'rows': len(df),
+        'columns': list(df.columns),
+        'keys': _key_columns(df, unique_columns)
+    })
+
+def _write_meta(file_path: str, meta: Dict):
+    with open(_meta_path(file_path), 'wb') as f:
+        f.write(orjson.dumps(meta) + b"\n")
+
+def _append_meta(file_path: str, rows: int, keys: Dict[str, List[str]]):
+    """Дописує в sidecar лише дельту (нові рядки та їх ключі) - без перезапису всіх ключів"""
+    with open(_meta_path(file_path), 'ab') as f:
+        f.write(orjson.dumps({'rows': rows, 'keys': keys}) + b"\n")
+
+def _key_columns(df: pd.DataFrame, unique_columns: List[str]) -> Dict[str, List[str]]:
+    """Значення ключів дедуплікації по колонках (як рядки, щоб пережити round-trip через CSV)"""
+    return {col: df[col].astype(str).tolist() for col in unique_columns}
+
+# Типи колонок збережених файлів - фіксуються при створенні DataFrame та при читанні CSV,
+# щоб pandas не вгадував їх (ціни лишаються float64 - float32 втрачає точність).
+# chain/market - звичайні рядки, не category: fastparquet дописує row groups зі своїм
+# набором категорій, і файл з різними наборами читається некоректно
+MARKETS_DTYPES = {
+    'unique_id': 'str', 'fetched_at': 'str', 'chain': 'str', 'market': 'str',
+    **{col: 'float64' for col in MARKET_NUMERIC_COLUMNS}, 'spread_pct': 'float64',
+}
+TRADING_DTYPES = {
+    'date': 'str', 'chain': 'str', 'daily_volume': 'float64',
+    'trades_count': 'Int64', 'unique_traders': 'Int64', 'avg_trade_size': 'float64',
+}
+TVL_DTYPES = {'fetched_at': 'str', 'date': 'str', 'chain': 'str', 'tvl_usd': 'float64'}
+FUNDING_DTYPES = {
+    'chain': 'str', 'market': 'str', 'funding_rate': 'float64',
+    'funding_time': 'str', 'next_funding_time': 'str', 'fetched_at': 'str',
+}
+FILE_DTYPES = {
+    MARKETS_FILE: MARKETS_DTYPES,
+    TRADING_FILE: TRADING_DTYPES,
+    TVL_FILE: TVL_DTYPES,
+    FUNDING_FILE: FUNDING_DTYPES,
+}
+
+def _with_schema(df: pd.DataFrame, dtypes: Dict[str, str]) -> pd.DataFrame:
+    """Приводить колонки до зафіксованих типів файлу (колонки, яких немає в df, пропускаються)"""
+    return df.astype({col: dtype for col, dtype in dtypes.items() if col in df.columns})
+
+def _write_table(df: pd.DataFrame, file_path: str, append: bool = False):
+    """
+    Записує (або дописує) дані у parquet файл через fastparquet
+    (append додає новий row group без перезапису)
+    """
+    fastparquet.write(file_path, df, append=append, compression='ZSTD',
+                      file_scheme='simple', write_index=False)
+
+def _compact_file(file_path: str, df: pd.DataFrame, unique_columns: List[str], max_rows: int,
+                  source_path: Optional[str] = None) -> pd.DataFrame:
+    """
+    Повністю переписує файл: існуючі + нові рядки, дедуплікація та обмеження розміру.
+    Upsert виконується одним запитом DuckDB, який читає parquet напряму з диска
+    (новіший запис з тим самим ключем перемагає).
+    Рядки зберігаються від старіших до новіших, щоб нові дані можна було дописувати в кінець.
+    source_path - звідки читати існуючі рядки, якщо це інший файл (міграція з CSV)
+    Читаються лише колонки поточної схеми - застарілі колонки відкидаються при перезаписі
+    """
+    columns = list(df.columns)
+    con = duckdb.connect()
+    try:
+        con.register('new_rows', df.assign(_pos=np.arange(len(df))))
+        if source_path:
+            # Старий CSV зберігався від новіших до старіших - впорядковуємо за часом
+            con.register('legacy_rows', pd.read_csv(source_path, usecols=lambda col: col in columns,
+                                                    dtype=FILE_DTYPES.get(file_path), engine='c'))
+            time_col = 'fetched_at' if 'fetched_at' in columns else 'date'
+            existing = f'SELECT *, row_number() OVER (ORDER BY "{time_col}") AS _pos FROM legacy_rows'
+        else:
+            # Файл вже впорядкований за часом дописування
+            stored = set(fastparquet.ParquetFile(file_path).columns)
+            select = ', '.join(f'"{col}"' for col in columns if col in stored)
+            path = file_path.replace("'", "''")
+            existing = (f"SELECT {select}, file_row_number AS _pos "
+                        f"FROM read_parquet('{path}', file_row_number = true)")
+        keys = ', '.join(f'"{col}"' for col in unique_columns)
+        output = ', '.join(f'"{col}"' for col in columns)
+        combined = con.execute(f"""
+            WITH combined AS (
+                SELECT *, 0 AS _src FROM ({existing})
+                UNION ALL BY NAME
+                SELECT *, 1 AS _src FROM new_rows
+            ), latest AS (
+                SELECT * FROM combined
+                QUALIFY row_number() OVER (PARTITION BY {keys} ORDER BY _src DESC, _pos DESC) = 1
+                ORDER BY _src DESC, _pos DESC
+                LIMIT {max_rows}
+            )
+            SELECT {output} FROM latest ORDER BY _src, _pos
+        """).df()
+    finally:
+        con.close()
     
-    return rows
+    _write_table(combined, file_path)
+    _save_meta(file_path, combined, unique_columns)
+    return combined
 
-def save_data_with_deduplication(df: pd.DataFrame, filename: str, unique_columns: List[str]):
+def save_data_with_deduplication(df: pd.DataFrame, file_path: str, unique_columns: List[str]):
     """
-    Зберігає дані з дедуплікацією та обмеженням розміру
+    Зберігає дані з дедуплікацією та обмеженням розміру.
+    Нові записи дописуються в кінець файлу без його читання; повний перезапис
+    (компактизація) лише коли ключі перетинаються з існуючими, змінилась схема
+    або файл виріс понад max_rows * COMPACTION_FACTOR.
     """
-    file_path = os.path.join(UPLOADS_DIR, filename)
+    filename = os.path.basename(file_path)
+    max_rows = 100000 if 'markets' in filename else 50000
+    df = df.drop_duplicates(subset=unique_columns, keep='last')
+    file_exists = os.path.exists(file_path)
     
-    if os.path.exists(file_path):
+    # Історія, збережена до переходу на parquet, переноситься з CSV один раз;
+    # CSV не видаляється, а перейменовується в резервну копію (.csv.migrated)
+    legacy_csv = os.path.splitext(file_path)[0] + '.csv'
+    if file_path.endswith('.parquet') and not file_exists and os.path.exists(legacy_csv):
         try:
-            # Читаємо існуючі дані
-            existing = pd.read_csv(file_path)
-            
-            # Об'єднуємо з новими
-            combined = pd.concat([existing, df], ignore_index=True)
-            
-            # Дедуплікація по унікальних колонках
-            combined = combined.drop_duplicates(subset=unique_columns, keep='last')
+            combined = _compact_file(file_path, df, unique_columns, max_rows, source_path=legacy_csv)
+            backup_csv = legacy_csv + '.migrated'
+            os.replace(legacy_csv, backup_csv)
+            ROW_COUNTS[file_path] = len(combined)
+            print(f"✅ Migrated {os.path.basename(legacy_csv)} to {filename}: {len(df)} new rows, {len(combined)} total rows "
+                  f"(backup: {os.path.basename(backup_csv)})")
+            return
+        except Exception as e:
+            print(f"❌ Error migrating {os.path.basename(legacy_csv)}: {e}")
+    
+    if file_exists:
+        try:
+            meta = _load_meta(file_path)
             
-            # Сортуємо по часу (новіші записи зверху)
-            if 'fetched_at' in combined.columns:
-                combined = combined.sort_values('fetched_at', ascending=False)
-            elif 'date' in combined.columns:
-                combined = combined.sort_values('date', ascending=False)
+            needs_compaction = (
+                meta is None
+                or meta.get('columns') != list(df.columns)
+                or meta['rows'] + len(df) > max_rows * COMPACTION_FACTOR
+                # Файли, записані раніше з category колонками, переписуються один раз
+                or (file_path.endswith('.parquet') and bool(fastparquet.ParquetFile(file_path).categories))
+            )
+            if not needs_compaction:
+                # Перевіряємо чи є нові ключі серед вже збережених (хешований lookup по MultiIndex)
+                new_keys = _key_columns(df, unique_columns)
+                new_index = pd.MultiIndex.from_arrays([new_keys[col] for col in unique_columns])
+                existing_index = pd.MultiIndex.from_arrays([meta['keys'][col] for col in unique_columns])
+                needs_compaction = bool(new_index.isin(existing_index).any())
             
-            # Обмежуємо розмір файлу
-            max_rows = 100000 if 'markets' in filename else 50000
-            combined = combined.head(max_rows)
+            if not needs_compaction:
+                # Тільки дописуємо нові рядки
+                try:
+                    _write_table(df, file_path, append=True)
+                except ValueError as e:
+                    # Типи колонок не збігаються з існуючим файлом - перезаписуємо повністю
+                    print(f"⚠️ Cannot append to {filename} ({e}), compacting instead")
+                    needs_compaction = True
             
-            combined.to_csv(file_path, index=False)
-            print(f"✅ Updated {filename}: {len(df)} new rows, {len(combined)} total rows")
+            if needs_compaction:
+                combined = _compact_file(file_path, df, unique_columns, max_rows)
+                ROW_COUNTS[file_path] = len(combined)
+                print(f"✅ Compacted {filename}: {len(df)} new rows, {len(combined)} total rows")
+            else:
+                _append_meta(file_path, len(df), new_keys)
+                meta['rows'] += len(df)
+                ROW_COUNTS[file_path] = meta['rows']
+                print(f"✅ Appended to {filename}: {len(df)} new rows, {meta['rows']} total rows")
             
         except Exception as e:
             print(f"❌ Error updating {filename}: {e}")
-            df.to_csv(file_path, index=False)
+            _write_table(df, file_path)
+            _save_meta(file_path, df, unique_columns)
+            ROW_COUNTS[file_path] = len(df)
             print(f"✅ Recreated {filename}: {len(df)} rows")
     else:
         # Створюємо новий файл
-        df.to_csv(file_path, index=False)
+        _write_table(df, file_path)
+        _save_meta(file_path, df, unique_columns)
+        ROW_COUNTS[file_path] = len(df)
         print(f"✅ Created {filename}: {len(df)} rows")
 
 def save_tvl_data(tvl_data: Dict):
@@ -294,32 +622,22 @@ def save_tvl_data(tvl_data: Dict):
     try:
         current_time = datetime.utcnow().isoformat() + "Z"
         current_date = current_time[:10]  # YYYY-MM-DD
-        tvl_records = []
-        
-        # Загальний поточний TVL
-        total_tvl = tvl_data.get('tvl', 0)
-        if total_tvl > 0:
-            tvl_records.append({
-                'fetched_at': current_time,
-                'date': current_date,
-                'chain': 'total',
-                'tvl_usd': float(total_tvl)
-            })
         
-        # TVL по окремих мережах (поточний)
+        # Загальний поточний TVL + TVL по окремих мережах (поточний), одним DataFrame
         chain_tvls = tvl_data.get('chainTvls', {})
-        for chain, tvl_value in chain_tvls.items():
-            if isinstance(tvl_value, (int, float)) and tvl_value > 0:
-                tvl_records.append({
-                    'fetched_at': current_time,
-                    'date': current_date,
-                    'chain': str(chain).lower(),
-                    'tvl_usd': float(tvl_value)
-                })
+        chains = ['total'] + [str(chain).lower() for chain in chain_tvls]
+        values = [tvl_data.get('tvl', 0)] + list(chain_tvls.values())
         
-        if tvl_records:
-            df = pd.DataFrame(tvl_records)
-            save_data_with_deduplication(df, "extended_tvl_data.csv", ['date', 'chain'])
+        df = pd.DataFrame({
+            'fetched_at': current_time,
+            'date': current_date,
+            'chain': chains,
+            'tvl_usd': [float(value) if isinstance(value, (int, float)) else 0.0 for value in values]
+        })
+        df = _with_schema(df[df['tvl_usd'] > 0], TVL_DTYPES)
+        
+        if not df.empty:
+            save_data_with_deduplication(df, TVL_FILE, ['date', 'chain'])
         else:
             print("⚠️ No valid TVL data to save")
             
@@ -327,79 +645,102 @@ def save_tvl_data(tvl_data: Dict):
         print(f"❌ Error processing TVL data: {e}")
         print("TVL data structure:", tvl_data)
 
+async def collect_api_data(trading_dates: Dict[str, List[str]]) -> Tuple[Dict[str, List[Dict]], List[pd.DataFrame], List[pd.DataFrame], List[Dict], Optional[Dict]]:
+    """
+    Збирає всі дані з API на одному event loop: markets, статистика торгів та TVL паралельно,
+    потім funding rates та order book - лише для мереж, чиї markets отримано на першому кроці
+    """
+    connector = aiohttp.TCPConnector(limit=ASYNC_CONCURRENCY, limit_per_host=ASYNC_LIMIT_PER_HOST,
+                                     keepalive_timeout=KEEPALIVE_TIMEOUT, ttl_dns_cache=DNS_CACHE_TTL)
+    # Без total: очікування вільного з'єднання в пулі не має рахуватися як таймаут запиту
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=TIMEOUT, sock_read=TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, headers=HEADERS, trust_env=True,
+                                     timeout=timeout,
+                                     raise_for_status=True) as session:
+        markets, trading_stats, tvl_data = await asyncio.gather(
+            asyncio.gather(*[fetch_markets_data(session, chain) for chain in CHAINS]),
+            asyncio.gather(*[fetch_trading_stats_range(session, chain, dates) for chain, dates in trading_dates.items()]),
+            fetch_tvl_data(session),
+        )
+        markets_by_chain = dict(zip(CHAINS, markets))
+        
+        # Funding rates та order book для топ ринків - не витрачаємо запити на мережі, які не відповіли
+        active_markets = {chain: chain_markets for chain, chain_markets in markets_by_chain.items() if chain_markets}
+        funding, orderbooks = await asyncio.gather(
+            asyncio.gather(*[fetch_funding_rates(session, chain) for chain in active_markets]),
+            asyncio.gather(*[
+                fetch_orderbook_snapshots(session, chain, [m.get('name', '') for m in chain_markets if m.get('name')])
+                for chain, chain_markets in active_markets.items()
+            ]),
+        )
+    
+    return (
+        markets_by_chain,
+        [frame for frame in funding if not frame.empty],
+        [frame for frame in orderbooks if not frame.empty],
+        [stats for chain_stats in trading_stats for stats in chain_stats],
+        tvl_data,
+    )
+
 def main():
     """Головна функція - збирає всі дані Extended біржі"""
     print("🚀 Starting Enhanced Extended Exchange data collection...")
     ensure_uploads_dir()
     
-    # === 1. ЗБИРАЄМО ДАНІ РИНКІВ ===
-    all_markets_data = []
-    all_funding_data = []
-    all_orderbook_data = []
-    
-    for chain in ['ethereum', 'starknet']:
-        # Markets
-        markets = fetch_markets_data(chain)
-        if markets:
-            normalized = normalize_markets_data(markets, chain)
-            all_markets_data.extend(normalized)
-            
-            # Funding rates
-            funding_data = fetch_funding_rates(chain)
-            all_funding_data.extend(funding_data)
-            
-            # Order book для топ ринків
-            market_names = [m.get('name', '') for m in markets if m.get('name')]
-            orderbook_data = fetch_orderbook_snapshots(chain, market_names)
-            all_orderbook_data.extend(orderbook_data)
+    # Дати по мережах для статистики торгів за останні TRADING_HISTORY_DAYS днів
+    today = datetime.utcnow().date()
+    dates = [(today - timedelta(days=days_back)).isoformat() for days_back in range(TRADING_HISTORY_DAYS)]
+    
+    # Перевіряємо активність мережі (дати YYYY-MM-DD порівнюються як рядки, без strptime)
+    trading_dates = {chain: [date for date in dates if date >= ENDPOINTS[chain]['start_date']] for chain in CHAINS}
+    
+    # Всі запити до API виконуються паралельно
+    markets_by_chain, funding_frames, orderbook_frames, trading_stats, tvl_data = asyncio.run(
+        collect_api_data(trading_dates))
+    
+    # === 1. ОБРОБЛЯЄМО ДАНІ РИНКІВ ===
+    market_frames = [normalize_markets_data(markets, chain) for chain, markets in markets_by_chain.items() if markets]
     
     # Зберігаємо markets data
-    if all_markets_data:
-        markets_df = pd.DataFrame(all_markets_data)
-        save_data_with_deduplication(markets_df, "extended_markets_data.csv", ['unique_id'])
+    if market_frames:
+        markets_df = _with_schema(pd.concat(market_frames, ignore_index=True), MARKETS_DTYPES)
+        save_data_with_deduplication(markets_df, MARKETS_FILE, ['unique_id'])
     
     # Зберігаємо funding data
-    if all_funding_data:
-        funding_df = pd.DataFrame(all_funding_data)
-        save_data_with_deduplication(funding_df, "extended_funding_rates.csv", ['chain', 'market', 'funding_time'])
+    if funding_frames:
+        funding_df = _with_schema(pd.concat(funding_frames, ignore_index=True), FUNDING_DTYPES)
+        save_data_with_deduplication(funding_df, FUNDING_FILE, ['chain', 'market', 'funding_time'])
     
     # Orderbook відключений через помилки API
-    # if all_orderbook_data:
-    #     orderbook_df = pd.DataFrame(all_orderbook_data)
-    #     save_data_with_deduplication(orderbook_df, "extended_orderbook_snapshots.csv", ['chain', 'market', 'fetched_at'])
-    
-    # === 2. ЗБИРАЄМО СТАТИСТИКУ ТОРГІВ ===
-    trading_stats = []
-    
-    # Збираємо дані за останні 30 днів (більше історії)
-    for days_back in range(30):
-        date = (datetime.now() - timedelta(days=days_back)).strftime('%Y-%m-%d')
-        
-        for chain in ['ethereum', 'starknet']:
-            # Перевіряємо активність мережі
-            start_date = datetime.strptime(ENDPOINTS[chain]['start_date'], '%Y-%m-%d')
-            check_date = datetime.strptime(date, '%Y-%m-%d')
-            
-            if check_date >= start_date:
-                stats = fetch_trading_stats(chain, date)
-                trading_stats.append(stats)
+    # if orderbook_frames:
+    #     orderbook_df = pd.concat(orderbook_frames, ignore_index=True)
+    #     save_data_with_deduplication(orderbook_df, ORDERBOOK_FILE, ['chain', 'market', 'fetched_at'])
     
+    # === 2. ЗБЕРІГАЄМО СТАТИСТИКУ ТОРГІВ ===
     if trading_stats:
-        trading_df = pd.DataFrame(trading_stats)
-        save_data_with_deduplication(trading_df, "extended_trading_stats.csv", ['date', 'chain'])
+        trading_df = _with_schema(pd.DataFrame(trading_stats), TRADING_DTYPES)
+        save_data_with_deduplication(trading_df, TRADING_FILE, ['date', 'chain'])
     
-    # === 3. ЗБИРАЄМО TVL ДАНІ ===
-    tvl_data = fetch_tvl_data()
+    # === 3. ЗБЕРІГАЄМО TVL ДАНІ ===
     if tvl_data:
         save_tvl_data(tvl_data)
     
     print("✅ Enhanced data collection completed!")
-    print("📁 Check uploads/ directory for CSV files:")
-    print("   - extended_markets_data.csv (markets with prices, volumes, OI)")
-    print("   - extended_trading_stats.csv (daily trading statistics)")
-    print("   - extended_tvl_data.csv (TVL data)")
-    print("   - extended_funding_rates.csv (funding rates history)")
-    print("   - extended_orderbook_snapshots.csv (order book depth)")
+    print("📁 Check uploads/ directory for data files:")
+    for file_path, description in [
+        (MARKETS_FILE, "markets with prices, volumes, OI"),
+        (TRADING_FILE, "daily trading statistics"),
+        (TVL_FILE, "TVL data"),
+        (FUNDING_FILE, "funding rates history"),
+        (ORDERBOOK_FILE, "order book depth"),
+    ]:
+        filename = os.path.basename(file_path)
+        if file_path in ROW_COUNTS:
+            print(f"   - {filename} ({description}): {ROW_COUNTS[file_path]} rows")
+        elif os.path.exists(file_path):
+            print(f"   - {filename} ({description}): {os.path.getsize(file_path) / 1024:.1f} KB")
+        else:
+            print(f"   - {filename} ({description}): not updated")
 
 if __name__ == "__main__":
     main()
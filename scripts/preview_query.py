@@ -2,7 +2,6 @@ import os
 from dune_client.client import DuneClient
 from dotenv import load_dotenv
 import sys
-import pandas as pd
 
 dotenv_path = os.path.join(os.path.dirname(__file__), '..', '.env')
 load_dotenv(dotenv_path)
@@ -27,6 +26,8 @@ if len(found_files) != 0:
     print('select * from (\n' + query_text + '\n) limit 20')
 
     results = dune.run_sql('select * from (\n' + query_text + '\n) limit 20')
+    # pandas is only needed to display results, so it is imported after the query succeeds
+    import pandas as pd
     # print(results.result.rows)
     results = pd.DataFrame(data=results.result.rows)
     print('\n')
@@ -21,13 +21,15 @@ with open(queries_yml, 'r', encoding='utf-8') as file:
 # Extract the query_ids from the data
 query_ids = [id for id in data['query_ids']]
 
+# List the /queries folder once instead of once per query
+queries_path = os.path.join(os.path.dirname(__file__), '..', 'queries')
+files = os.listdir(queries_path)
+
 for id in query_ids:
     query = dune.get_query(id)
     print('PROCESSING: query {}, {}'.format(query.base.query_id, query.base.name))
 
     # Check if query file exists in /queries folder
-    queries_path = os.path.join(os.path.dirname(__file__), '..', 'queries')
-    files = os.listdir(queries_path)
     found_files = [file for file in files if str(id) == file.split('___')[-1].split('.')[0]]
     
     if len(found_files) != 0:
@@ -4,6 +4,11 @@ from dotenv import load_dotenv
 import sys
 import codecs
 import os
+import tempfile
+import hashlib
+import json
+import duckdb
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Set the default encoding to UTF-8
 sys.stdout = codecs.getwriter("utf-8")(sys.stdout.detach())
@@ -13,20 +18,115 @@ load_dotenv(dotenv_path)
 
 dune = DuneClient.from_env()
 
+# Uploads are network-bound, so a few run at once over the client's pooled session
+UPLOAD_CONCURRENCY = 4
+
+# Parquet history is exported to CSV at upload time, plain CSV files are sent as-is
+PARQUET_EXTENSION = ".parquet"
+UPLOAD_EXTENSIONS = (".csv", PARQUET_EXTENSION)
+
+# Fingerprints of the last successful upload per file (kept in the CI-cached .cache dir).
+# Files whose content has not changed since then are not exported or uploaded again
+MANIFEST_PATH = os.path.join(os.path.dirname(__file__), '..', '.cache', 'upload_manifest.json')
+
+# Re-upload everything regardless of the manifest, e.g. after a Dune table was deleted or overwritten
+FORCE_UPLOAD = '--force' in sys.argv[1:] or os.getenv('DUNE_FORCE_UPLOAD') == '1'
+
 uploads_path = os.path.join(os.path.dirname(__file__), '..', 'uploads')
-files = os.listdir(uploads_path)
+# One directory scan; entries carry their own path and file type
+with os.scandir(uploads_path) as entries:
+    upload_files = [entry for entry in entries if entry.is_file() and entry.name.endswith(UPLOAD_EXTENSIONS)]
 
-if len(files) == 0:
+def table_name_for(file_name):
+    return file_name.split(".")[0].lower().replace(' ', '_')
+
+# Each Dune table must come from exactly one file. A legacy .csv left next to the .parquet
+# that replaced it (e.g. after a failed migration) is skipped, so the two never race on one table
+parquet_tables = {table_name_for(entry.name) for entry in upload_files if entry.name.endswith(PARQUET_EXTENSION)}
+for entry in upload_files:
+    if not entry.name.endswith(PARQUET_EXTENSION) and table_name_for(entry.name) in parquet_tables:
+        print(f'WARNING: skipped "{entry.name}", table "{table_name_for(entry.name)}" is uploaded from its .parquet file')
+upload_files = [entry for entry in upload_files
+                if entry.name.endswith(PARQUET_EXTENSION) or table_name_for(entry.name) not in parquet_tables]
+
+if len(upload_files) == 0:
     exit() 
     
-for file in files:
-    if not file.endswith(".csv"):
-        continue
-    file_name = file.split(".")[0].lower().replace(' ', '_')
-    with open(os.path.join(uploads_path, file), 'r') as file:
-        table = dune.upload_csv(
-            data=str(file.read()),
-            table_name=file_name,
-            is_private=False
-        )
+def export_to_csv_for_dune(file_path):
+    # Parquet history files are converted to CSV text only at upload time.
+    # DuckDB's native CSV writer streams the conversion instead of building a DataFrame
+    source = file_path.replace("'", "''")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, 'export.csv')
+        # A connection per call: the default module-level connection is not safe across threads
+        with duckdb.connect() as con:
+            con.execute(f"COPY (SELECT * FROM read_parquet('{source}')) TO '{csv_path}' (HEADER)")
+        with open(csv_path, 'r') as f:
+            return f.read()
+
+def load_manifest():
+    try:
+        with open(MANIFEST_PATH, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(manifest):
+    os.makedirs(os.path.dirname(MANIFEST_PATH), exist_ok=True)
+    with open(MANIFEST_PATH, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+def file_fingerprint(entry, cached):
+    # The stored hash is reused while mtime and size match, otherwise the file is re-hashed
+    stat = entry.stat()
+    if cached and cached.get('mtime_ns') == stat.st_mtime_ns and cached.get('size') == stat.st_size:
+        return cached
+    digest = hashlib.sha256()
+    with open(entry.path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': digest.hexdigest()}
+
+def upload_file(entry):
+    file_name = table_name_for(entry.name)
+    if entry.name.endswith(PARQUET_EXTENSION):
+        data = export_to_csv_for_dune(entry.path)
+    else:
+        with open(entry.path, 'r') as f:
+            data = str(f.read())
+    table = dune.upload_csv(
+        data=data,
+        table_name=file_name,
+        is_private=False
+    )
+    return file_name, table
+
+manifest = load_manifest()
+fingerprints = {entry.name: file_fingerprint(entry, manifest.get(entry.name)) for entry in upload_files}
+pending = []
+for entry in upload_files:
+    if not FORCE_UPLOAD and manifest.get(entry.name, {}).get('sha256') == fingerprints[entry.name]['sha256']:
+        print(f'skipped unchanged file "{entry.name}"')
+        manifest[entry.name] = fingerprints[entry.name]
+    else:
+        pending.append(entry)
+
+# Every upload is settled before anything is raised, so all successes reach the manifest
+errors = []
+with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as executor:
+    futures = {executor.submit(upload_file, entry): entry for entry in pending}
+    for future in as_completed(futures):
+        entry = futures[future]
+        try:
+            file_name, table = future.result()
+        except Exception as e:
+            print(f'ERROR: failed to upload "{entry.name}": {e}')
+            errors.append(e)
+            continue
         print(f'uploaded table "{file_name}"')
+        if table:
+            manifest[entry.name] = fingerprints[entry.name]
+
+save_manifest(manifest)
+if errors:
+    raise errors[0]